@@ -0,0 +1,232 @@
+# apply_denoisers.py
+# %%
+from pathlib import Path
+import urllib
+import zipfile
+from argparse import ArgumentParser
+import queue
+import json
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# import tensorflow as tf
+import SimpleITK as sitk
+
+from denoising.networks import RED_CNN, predict, load_exported_model
+
+import os
+import sys
+import torch
+from collections import OrderedDict
+
+
+def load_model(save_path, iter_=13000, multi_gpu=False):
+    exported = os.path.join(save_path, 'REDCNN_{}iter.pt2'.format(iter_))
+    if os.path.exists(exported): # compiled with denoising/export.py
+        model = load_exported_model(exported)
+        model.checkpoint_hash = file_hash(exported)
+        return model
+    REDCNN = RED_CNN()
+    f = os.path.join(save_path, 'REDCNN_{}iter.ckpt'.format(iter_))
+    REDCNN.checkpoint_hash = file_hash(f)
+    if multi_gpu:
+        state_d = OrderedDict()
+        for k, v in torch.load(f):
+            n = k[7:]
+            state_d[n] = v
+        REDCNN.load_state_dict(state_d)
+        return REDCNN
+    else:
+        REDCNN.load_state_dict(torch.load(f))
+        return REDCNN
+
+
+def file_hash(f, sha1=None):
+    sha1 = sha1 or hashlib.sha1()
+    with open(f, 'rb') as fid:
+        for chunk in iter(lambda: fid.read(1 << 24), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def model_hash(model):
+    # checkpoint file hash set by load_model, otherwise a hash of the weights
+    if hasattr(model, 'checkpoint_hash'):
+        return model.checkpoint_hash
+    sha1 = hashlib.sha1()
+    for k, v in model.state_dict().items():
+        sha1.update(k.encode())
+        sha1.update(v.cpu().numpy().tobytes())
+    return sha1.hexdigest()
+
+
+def series_hash(series, manifest):
+    """sha1 of a .mhd header and its data file, reused from the manifest while their size and mtime are unchanged"""
+    header = series.read_text(errors='ignore')
+    data_file = [l.split('=')[1].strip() for l in header.splitlines() if l.startswith('ElementDataFile')]
+    files = [series] + [series.parent / f for f in data_file if f != 'LOCAL']
+    stats = [[f.stat().st_size, f.stat().st_mtime] for f in files]
+    entry = manifest['inputs'].get(str(series))
+    if entry and (entry['stats'] == stats):
+        return entry['sha1']
+    sha1 = hashlib.sha1()
+    for f in files:
+        file_hash(f, sha1)
+    manifest['inputs'][str(series)] = {'stats': stats, 'sha1': sha1.hexdigest()}
+    return sha1.hexdigest()
+
+
+def load_manifest(manifest_file):
+    if manifest_file.exists():
+        return json.loads(manifest_file.read_text())
+    return {'inputs': {}, 'outputs': {}}
+
+
+def is_current(manifest, output, input_sha1, model_sha1):
+    entry = manifest['outputs'].get(str(output))
+    return output.exists() and (entry is not None) and (entry['input_sha1'] == input_sha1) and (entry['model_sha1'] == model_sha1)
+
+
+# %%
+
+def find_series(input_dir, output_dir, kernel, names, overwrite, manifest=None, model_hashes=None):
+    for series in input_dir.rglob('*.mhd'):
+        if kernel not in series.parts: continue
+        if (series.stem == 'ground_truth') or (series.stem == 'noise_free') or (series.stem == 'true'):
+            continue
+        output = Path(str(series).replace(str(input_dir), str(output_dir)))
+        outputs = {name: Path(str(output).replace('fbp', name)) for name in names}
+        input_sha1 = None
+        if manifest is not None: # incremental, only new or changed series and models
+            input_sha1 = series_hash(series, manifest)
+            outputs = {name: o for name, o in outputs.items() if not is_current(manifest, o, input_sha1, model_hashes[name])}
+        elif not overwrite:
+            outputs = {name: o for name, o in outputs.items() if not o.exists()}
+        if not outputs:
+            print(f'{series} already denoised, skipping {", ".join(names)}')
+            continue
+        yield series, outputs, input_sha1
+
+
+def read_series(series, offset):
+    input_image = sitk.ReadImage(series)
+    x, y, z = input_image.GetWidth(), input_image.GetHeight(), input_image.GetDepth()
+    input_array = sitk.GetArrayViewFromImage(input_image).reshape(z, 1, x, y).astype('float32') - offset
+    return input_array, (z, y, x)
+
+
+def write_series(sp_denoised, output, input_shape, name):
+    output_image = sitk.GetImageFromArray(sp_denoised.squeeze())
+    assert((output_image.GetDepth(),output_image.GetHeight(),output_image.GetWidth())==input_shape)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    sitk.WriteImage(output_image, output)
+    print(f'{name} --> {output}')
+
+
+def prefetch_series(series_list, reader_pool, prefetch_queue, offset):
+    # runs in its own thread, the bounded queue blocks it once `prefetch` series are read ahead of the compute stage
+    # ends with None, or with the exception that stopped it so `denoise` re-raises it instead of returning early
+    try:
+        for series, outputs, input_sha1 in series_list:
+            prefetch_queue.put((series, outputs, input_sha1, reader_pool.submit(read_series, series, offset)))
+    except BaseException as e:
+        prefetch_queue.put(e)
+    else:
+        prefetch_queue.put(None)
+
+
+def record_output(manifest, manifest_file, output, series, input_sha1, model_sha1):
+    manifest['outputs'][str(output)] = {'input': str(series), 'input_sha1': input_sha1, 'model_sha1': model_sha1}
+    snapshot = {k: dict(v) for k, v in manifest.items()} # atomic copies, the reader thread may be adding inputs
+    # written beside and renamed over the manifest so a killed run never leaves it truncated
+    tmp_file = manifest_file.with_name(manifest_file.name + '.tmp')
+    tmp_file.write_text(json.dumps(snapshot, indent=1))
+    os.replace(tmp_file, manifest_file)
+
+
+def denoise(input_dir, output_dir=None, kernel='fbp', model=None, name=None, offset=1000, batch_size=32, overwrite=True, tile_size=None,
+            n_readers=2, prefetch=2, models=None, incremental=False):
+    """denoises every `kernel` series under `input_dir` as a pipeline: a pool of `n_readers` threads reads up to `prefetch`
+    series ahead, the main thread runs the model and a writer thread saves results while the next series is denoised,
+    with at most `prefetch` denoised series waiting to be written
+
+    `models` ({name: model}) runs several models on each series read, writing each model's output to its own `name` recon
+    directory, otherwise the single `model` and `name` are used
+
+    `incremental` records each output's input series hash and model checkpoint hash in `output_dir`/denoise_manifest.json
+    and only reprocesses series that are new or changed, or models that changed, since the last run
+    """
+    dev = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    models = models or {name: model}
+    for model in models.values():
+        if isinstance(model, torch.nn.Module): model.to(dev)
+    # exported packages run on the device they were compiled for, see load_exported_model
+    devices = {name: getattr(model, 'device', dev) for name, model in models.items()}
+
+    output_dir = output_dir or input_dir
+    manifest, model_hashes = None, None
+    if incremental:
+        manifest_file = Path(output_dir) / 'denoise_manifest.json'
+        manifest = load_manifest(manifest_file)
+        model_hashes = {name: model_hash(model) for name, model in models.items()}
+
+    def write(sp_denoised, output, input_shape, name, series, input_sha1):
+        write_series(sp_denoised, output, input_shape, name)
+        if incremental: # only the single writer thread updates the manifest
+            record_output(manifest, manifest_file, output, series, input_sha1, model_hashes[name])
+
+    series_list = find_series(input_dir, output_dir, kernel, list(models), overwrite, manifest, model_hashes)
+    prefetch_queue = queue.Queue(maxsize=prefetch)
+    write_slots = threading.Semaphore(prefetch) # bounds the denoised volumes waiting for the writer, as the queue bounds reads
+    with ThreadPoolExecutor(n_readers) as reader_pool, ThreadPoolExecutor(1) as writer:
+        producer = threading.Thread(target=prefetch_series, args=(series_list, reader_pool, prefetch_queue, offset), daemon=True)
+        producer.start()
+        writes = []
+        while (item := prefetch_queue.get()) is not None:
+            if isinstance(item, BaseException):
+                raise item
+            series, outputs, input_sha1, read = item
+            input_array, input_shape = read.result()
+            z = input_shape[0]
+            for name, output in outputs.items():
+                print(f'{name} denoising {series} of {z} images in batches of {min(batch_size, z)}')
+                sp_denoised = predict(models[name], input_array, batch_size=min(batch_size, z), device=devices[name], tile_size=tile_size)
+                write_slots.acquire()
+                writes.append(writer.submit(write, sp_denoised, output, input_shape, name, series, input_sha1))
+                writes[-1].add_done_callback(lambda w: write_slots.release())
+            done = [w for w in writes if w.done()]
+            [w.result() for w in done] # raise write errors early
+            writes = [w for w in writes if w not in done]
+        producer.join()
+        [w.result() for w in writes]
+# %%
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Apply denoiser')
+    parser.add_argument('base_directory', type=str, default="data", help='directory containing images to be processed')
+    parser.add_argument('--kernel', type=str, default="fbp", help='input kernel to be processed')
+    parser.add_argument('--model_dirs', type=str, nargs='+', help='checkpoint directories to apply instead of RED-CNN and RED-CNN augmented, outputs are named after each directory')
+    parser.add_argument('--iter', type=int, default=13000, help='checkpoint iteration to load from each of --model_dirs')
+    parser.add_argument('--incremental', action='store_true', help='only denoise series or models that changed since the last run, tracked in denoise_manifest.json')
+    parser.add_argument('--tile_size', type=int, default=None, help='denoise in overlapping tiles of this size to bound memory, e.g. for 1024x1024 images')
+    args = parser.parse_args()
+
+    data_dir = args.base_directory
+    data_dir = Path(data_dir)
+    kernel = args.kernel
+    if not data_dir.exists():
+        data_dir.mkdir(parents=True)
+        url = 'https://zenodo.org/record/7996580/files/large_dataset.zip?download=1'
+        fname = str(data_dir / 'CCT189.zip')
+        urllib.request.urlretrieve(url, fname)
+
+        with zipfile.ZipFile(fname,"r") as zip_ref:
+            zip_ref.extractall(fname.split('.zip')[0])
+    if args.model_dirs:
+        models = {Path(d).name: load_model(d, iter_=args.iter) for d in args.model_dirs}
+    else:
+        models = {'RED-CNN': load_model('denoising/models/redcnn'), 'RED-CNN augmented': load_model('denoising/models/redcnn_augmented')}
+    # each series is read once and denoised by every model
+    denoise(data_dir, data_dir, kernel=kernel, models=models, tile_size=args.tile_size, incremental=args.incremental)
+# %%
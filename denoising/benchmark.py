@@ -0,0 +1,90 @@
+import argparse
+import copy
+import time
+import timeit
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+from skimage.exposure import match_histograms
+
+from loader import get_patch, get_patches
+from noise_bank import HistogramMatcher
+from networks import RED_CNN
+
+
+def bench_get_patch(args):
+    full_input_img = np.random.randint(-1024, 3072, (args.image_size, args.image_size)).astype(np.int16)
+    full_target_img = np.random.randint(-1024, 3072, (args.image_size, args.image_size)).astype(np.int16)
+    rng = np.random.default_rng(0)
+
+    loop = lambda: get_patch(full_input_img, full_target_img, args.patch_n, args.patch_size)
+    vectorized = lambda: get_patches(full_input_img, full_target_img, args.patch_n, args.patch_size, rng)
+
+    for name, fn in [('get_patch (loop)', loop), ('get_patches (vectorized)', vectorized)]:
+        t = min(timeit.repeat(fn, number=args.number, repeat=args.repeat)) / args.number
+        print('{}: {:.1f} us per slice'.format(name, 1e6*t))
+
+
+def bench_match_histograms(args):
+    noise_patches = (25*np.random.randn(args.noise_patches, args.patch_size, args.patch_size)).astype(np.int16)
+    ref_images = (40*np.random.randn(args.batch_size*args.patch_n*args.patch_size**2, 1)).astype(np.float32)
+    matcher = HistogramMatcher(ref_images)
+
+    skimage_match = lambda: match_histograms(noise_patches.reshape(-1, 1), reference=ref_images)
+    lut_match = lambda: matcher(noise_patches)
+
+    for name, fn in [('match_histograms (skimage)', skimage_match), ('HistogramMatcher (lookup table)', lut_match)]:
+        t = min(timeit.repeat(fn, number=1, repeat=args.repeat))
+        print('{}: {:.1f} ms per diameter'.format(name, 1e3*t))
+
+
+def bench_amp(args):
+    # same initial weights and batches for the fp32 and bfloat16/channels_last paths
+    torch.manual_seed(0)
+    model = RED_CNN()
+    y = 40 + 20*torch.randn(args.batch_size*args.patch_n, 1, args.patch_size, args.patch_size)
+    x = y + 30*torch.randn_like(y)
+    criterion = nn.MSELoss()
+
+    for amp in [False, True]:
+        net = copy.deepcopy(model)
+        inputs = x
+        if amp:
+            net.to(memory_format=torch.channels_last)
+            inputs = x.contiguous(memory_format=torch.channels_last)
+        optimizer = optim.Adam(net.parameters(), 1e-5)
+        losses = []
+        for step in range(args.steps + 1):
+            if step == 1: # first step is warm up
+                start_time = time.time()
+            with torch.autocast(device_type='cpu', dtype=torch.bfloat16, enabled=amp):
+                pred = net(inputs)
+            loss = criterion(pred.float(), y)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            losses.append(loss.item())
+        steps_per_sec = args.steps / (time.time() - start_time)
+        print('{}: {:.2f} steps/sec, loss first {:.4f} last {:.4f}'.format('bfloat16 channels_last' if amp else 'fp32', steps_per_sec, losses[0], losses[-1]))
+        RED_CNN().load_state_dict(net.state_dict()) # checkpoints load into the fp32 model
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--bench', type=str, default='get_patch', choices=['get_patch', 'match_histograms', 'amp'])
+    parser.add_argument('--image_size', type=int, default=512)
+    parser.add_argument('--patch_n', type=int, default=10)
+    parser.add_argument('--patch_size', type=int, default=64)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--noise_patches', type=int, default=500)
+    parser.add_argument('--number', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--steps', type=int, default=10)
+
+    args = parser.parse_args()
+    {'get_patch': bench_get_patch,
+     'match_histograms': bench_match_histograms,
+     'amp': bench_amp}[args.bench](args)
@@ -0,0 +1,21 @@
+import os
+import argparse
+import torch
+
+from networks import RED_CNN, export_model
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compile a trained REDCNN_{iter}iter.ckpt into REDCNN_{iter}iter.pt2 for inference')
+
+    parser.add_argument('--save_path', type=str, default='./save/')
+    parser.add_argument('--test_iters', type=int, default=13000)
+    parser.add_argument('--device', type=str, default='cpu', help='device the package runs on, e.g. cuda for GPU inference')
+
+    args = parser.parse_args()
+
+    f = os.path.join(args.save_path, 'REDCNN_{}iter.ckpt'.format(args.test_iters))
+    model = RED_CNN()
+    model.load_state_dict(torch.load(f, map_location='cpu'))
+    output = export_model(model, os.path.join(args.save_path, 'REDCNN_{}iter.pt2'.format(args.test_iters)), device=args.device)
+    print('{} --> {}'.format(f, output))
@@ -1,7 +1,10 @@
 import os
 from glob import glob
 import numpy as np
-from torch.utils.data import Dataset, DataLoader
+from numpy.lib.stride_tricks import sliding_window_view
+from torch.utils.data import Dataset, DataLoader, get_worker_info
+
+from prep import STORE_INDEX, load_store_index
 
 
 class ct_dataset(Dataset):
@@ -9,12 +12,19 @@ class ct_dataset(Dataset):
         assert mode in ['train', 'test'], "mode is 'train' or 'test'"
         assert load_mode in [0,1], "load_mode is 0 or 1"
 
-        input_path = sorted(glob(os.path.join(saved_path, '*_input.npy')))
-        target_path = sorted(glob(os.path.join(saved_path, '*_target.npy')))
         self.load_mode = load_mode
         self.patch_n = patch_n
         self.patch_size = patch_size
         self.transform = transform
+        self.rng = None # set per worker by seed_worker
+
+        if os.path.exists(os.path.join(saved_path, STORE_INDEX)):
+            self._init_store(mode, saved_path, test_patient)
+            return
+
+        input_path = sorted(glob(os.path.join(saved_path, '*_input.npy')))
+        target_path = sorted(glob(os.path.join(saved_path, '*_target.npy')))
+        self.store = None
 
         if mode == 'train':
             input_ = [f for f in input_path if test_patient not in f]
@@ -35,26 +45,59 @@ class ct_dataset(Dataset):
                 self.input_ = [np.load(f) for f in input_]
                 self.target_ = [np.load(f) for f in target_]
 
+    def _init_store(self, mode, saved_path, test_patient):
+        # memory-mapped volumes written by prep.save_dataset, one (2, slices, h, w) file per patient
+        index = load_store_index(saved_path)
+        if mode == 'train':
+            index = [p for p in index if test_patient not in p['patient']]
+        else:
+            index = [p for p in index if test_patient in p['patient']]
+        self.store = [os.path.join(saved_path, p['file']) for p in index]
+        self.offsets = np.cumsum([0] + [p['n_slices'] for p in index])
+        self.volumes = {}
+        if self.load_mode == 1: # all data load, as views into the maps
+            volumes = [self.get_volume(v) for v in range(len(self.store))]
+            self.input_ = [s for vol in volumes for s in vol[0]]
+            self.target_ = [s for vol in volumes for s in vol[1]]
+
+    def get_volume(self, v):
+        # opened lazily so each DataLoader worker maps its own files
+        if v not in self.volumes:
+            self.volumes[v] = np.load(self.store[v], mmap_mode='r')
+        return self.volumes[v]
+
     def __len__(self):
+        if self.store is not None:
+            return int(self.offsets[-1])
         return len(self.target_)
 
-    def __getitem__(self, idx):
-        input_img, target_img = self.input_[idx], self.target_[idx]
-        if self.load_mode == 0:
-            input_img, target_img = np.load(input_img), np.load(target_img)
+    def get_slice(self, idx):
+        # whole (transformed) input and target slice, __getitem__ crops it into patches when patch_size is set
+        if (self.store is not None) and (self.load_mode == 0):
+            v = np.searchsorted(self.offsets, idx, side='right') - 1
+            volume = self.get_volume(v)
+            input_img, target_img = volume[0, idx - self.offsets[v]], volume[1, idx - self.offsets[v]]
+        else:
+            input_img, target_img = self.input_[idx], self.target_[idx]
+            if self.load_mode == 0:
+                input_img, target_img = np.load(input_img), np.load(target_img)
 
         if self.transform:
             input_img = self.transform(input_img)
             target_img = self.transform(target_img)
+        return input_img, target_img
 
+    def __getitem__(self, idx):
+        input_img, target_img = self.get_slice(idx)
         if self.patch_size:
-            input_patches, target_patches = get_patch(input_img,
-                                                      target_img,
-                                                      self.patch_n,
-                                                      self.patch_size)
+            input_patches, target_patches = get_patches(input_img,
+                                                        target_img,
+                                                        self.patch_n,
+                                                        self.patch_size,
+                                                        self.rng)
             return (input_patches, target_patches)
         else:
-            return (input_img, target_img)
+            return (np.array(input_img), np.array(target_img))
 
 
 def get_patch(full_input_img, full_target_img, patch_n, patch_size):
@@ -73,10 +116,32 @@ def get_patch(full_input_img, full_target_img, patch_n, patch_size):
     return np.array(patch_input_imgs), np.array(patch_target_imgs)
 
 
+def get_patches(full_input_img, full_target_img, patch_n, patch_size, rng=None):
+    # vectorized get_patch: all offsets drawn at once, input and target gathered from strided window views
+    assert full_input_img.shape == full_target_img.shape
+    h, w = full_input_img.shape
+    if rng is None:
+        top = np.random.randint(0, h-patch_size, size=patch_n)
+        left = np.random.randint(0, w-patch_size, size=patch_n)
+    else:
+        top = rng.integers(0, h-patch_size, size=patch_n)
+        left = rng.integers(0, w-patch_size, size=patch_n)
+    window = (patch_size, patch_size)
+    patch_input_imgs = sliding_window_view(full_input_img, window)[top, left].astype(np.int16, copy=False)
+    patch_target_imgs = sliding_window_view(full_target_img, window)[top, left].astype(np.int16, copy=False)
+    return patch_input_imgs, patch_target_imgs
+
+
+def seed_worker(worker_id):
+    worker_info = get_worker_info()
+    worker_info.dataset.rng = np.random.default_rng(worker_info.seed)
+
+
 def get_loader(mode='train', load_mode=0,
                saved_path=None, test_patient='L506',
                patch_n=None, patch_size=None,
-               transform=None, batch_size=32, num_workers=6):
+               transform=None, batch_size=32, num_workers=6, pin_memory=False):
     dataset_ = ct_dataset(mode, load_mode, saved_path, test_patient, patch_n, patch_size, transform)
-    data_loader = DataLoader(dataset=dataset_, batch_size=batch_size, shuffle=True, num_workers=num_workers)
+    data_loader = DataLoader(dataset=dataset_, batch_size=batch_size, shuffle=True, num_workers=num_workers,
+                             worker_init_fn=seed_worker, pin_memory=pin_memory)
     return data_loader
@@ -18,15 +18,18 @@ def main(args):
             os.makedirs(fig_path)
             print('Create path : {}'.format(fig_path))
 
+    # with --crop_on_device or --resident whole slices are loaded and Solver.train crops the patches
+    crop_in_loader = (args.mode=='train') and not (args.crop_on_device or args.resident)
     data_loader = get_loader(mode=args.mode,
                              load_mode=args.load_mode,
                              saved_path=args.saved_path,
                              test_patient=args.test_patient,
-                             patch_n=(args.patch_n if args.mode=='train' else None),
-                             patch_size=(args.patch_size if args.mode=='train' else None),
+                             patch_n=(args.patch_n if crop_in_loader else None),
+                             patch_size=(args.patch_size if crop_in_loader else None),
                              transform=args.transform,
                              batch_size=(args.batch_size if args.mode=='train' else 1),
-                             num_workers=args.num_workers)
+                             num_workers=(0 if (args.resident and args.mode=='train') else args.num_workers), # resident training never iterates the loader
+                             pin_memory=args.crop_on_device)
 
     solver = Solver(args, data_loader)
     if args.mode == 'train':
@@ -56,6 +59,8 @@ if __name__ == "__main__":
     parser.add_argument('--patch_n', type=int, default=10)
     parser.add_argument('--patch_size', type=int, default=64)
     parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--crop_on_device', action='store_true', help='move whole slices to the device and crop patches there')
+    parser.add_argument('--resident', action='store_true', help='keep the whole training set on the device and sample batches there (requires --load_mode=1)')
 
     parser.add_argument('--num_epochs', type=int, default=100)
     parser.add_argument('--print_iters', type=int, default=20)
@@ -64,6 +69,7 @@ if __name__ == "__main__":
     parser.add_argument('--test_iters', type=int, default=1000)
 
     parser.add_argument('--lr', type=float, default=1e-5)
+    parser.add_argument('--amp', action='store_true', help='train under bfloat16 autocast with channels_last memory format')
 
     parser.add_argument('--device', type=str)
     parser.add_argument('--num_workers', type=int, default=7)
@@ -71,6 +77,12 @@ if __name__ == "__main__":
 
     # my custom args
     parser.add_argument('--augment', type=float, default=0.35)
+    parser.add_argument('--noise_lambda_min', type=float, default=1.0)
+    parser.add_argument('--noise_lambda_max', type=float, default=1.0)
+    parser.add_argument('--noise_bank_size', type=int, default=3000, help='noise patches held in memory for augmentation, split evenly across diameters')
+    parser.add_argument('--noise_bank_refresh', type=int, default=1000, help='noise patches streamed into the bank at the start of each epoch so training samples across all noise patches over the epochs, 0 keeps the initial bank fixed')
+    parser.add_argument('--noise_cache_dir', type=str, help='cache for histogram matched noise patches, defaults to a cache folder in the noise patch directory')
+    parser.add_argument('--rebuild_noise_cache', action='store_true')
 
     args = parser.parse_args()
     main(args)
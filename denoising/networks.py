@@ -4,6 +4,8 @@ import torch.nn as nn
 import torch
 from tqdm import tqdm
 
+RECEPTIVE_MARGIN = 20 # each output pixel depends on inputs within 20 pixels (5 convolutions of kernel 5)
+
 class RED_CNN(nn.Module):
     def __init__(self, out_ch=96, norm_range_min=-1024, norm_range_max=3072):
         super(RED_CNN, self).__init__()
@@ -41,7 +43,7 @@ class RED_CNN(nn.Module):
         out = self.tconv3(self.relu(out))
         out += residual_2
         out = self.tconv4(self.relu(out))
-        out = self.tconv5(self.relu(out))
+        out = self.tconv5(self.relu(out)).float() # residual and denormalize in fp32 when run under autocast
         out += residual_1
         out = self.relu(out)
         out = self.denormalize(out)
@@ -55,23 +57,90 @@ class RED_CNN(nn.Module):
         image = image * (self.norm_range_max - self.norm_range_min) + self.norm_range_min
         return image
 
-    def predict(self, image, batch_size=1, device='cpu'):
-        if image.ndim == 2: image = image[None, None, :, :]
-        if image.dtype != 'float32': image = image.astype('float32')
-        with torch.no_grad():
-            n_images = image.shape[0]
-            if batch_size > n_images:
-                batch_size = n_images
-            batch_indices = np.arange(n_images)
-            if n_images % batch_size == 0:
-                batch_indices = np.split(batch_indices, n_images//batch_size)
-                if batch_size == 1: batch_indices = np.array(batch_indices).reshape(-1, 1)
-            else:
-                modulo=n_images % batch_size
-                batch_indices = np.split(batch_indices[:n_images-modulo], n_images//batch_size)
-                batch_indices.append(list(range(n_images-modulo, n_images)))
-            pred = np.zeros_like(image)
-            image = torch.tensor(image, device=device)
-            for batch in tqdm(batch_indices):
-                pred[batch] = self.forward(image[batch]).to('cpu').numpy()
-            return pred
+    def predict(self, image, batch_size=1, device='cpu', tile_size=None, overlap=RECEPTIVE_MARGIN):
+        return predict(self, image, batch_size=batch_size, device=device, tile_size=tile_size, overlap=overlap)
+
+
+def predict(model, image, batch_size=1, device='cpu', tile_size=None, overlap=RECEPTIVE_MARGIN):
+    """batched inference with any callable model, e.g. a `RED_CNN` or an exported model from `load_exported_model`
+
+    if `tile_size` is given images are denoised in overlapping `tile_size` x `tile_size` tiles packed `batch_size`
+    tiles at a time, see `predict_tiled`
+    """
+    if image.ndim == 2: image = image[None, None, :, :]
+    if image.dtype != 'float32': image = image.astype('float32')
+    if tile_size:
+        return predict_tiled(model, image, tile_size, batch_size=batch_size, device=device, overlap=overlap)
+    with torch.no_grad():
+        n_images = image.shape[0]
+        if batch_size > n_images:
+            batch_size = n_images
+        batch_indices = np.arange(n_images)
+        if n_images % batch_size == 0:
+            batch_indices = np.split(batch_indices, n_images//batch_size)
+            if batch_size == 1: batch_indices = np.array(batch_indices).reshape(-1, 1)
+        else:
+            modulo=n_images % batch_size
+            batch_indices = np.split(batch_indices[:n_images-modulo], n_images//batch_size)
+            batch_indices.append(list(range(n_images-modulo, n_images)))
+        pred = np.zeros_like(image)
+        image = torch.tensor(image, device=device)
+        for batch in tqdm(batch_indices):
+            pred[batch] = model(image[batch]).to('cpu').numpy()
+        return pred
+
+
+def tile_starts(length, tile_size, overlap):
+    # tile start positions along one axis and the [begin, end) range of each tile's output that is kept
+    tile_size = min(tile_size, length)
+    core = tile_size - 2*overlap
+    assert (core > 0) or (tile_size == length), 'tile_size must be larger than 2*overlap'
+    starts = sorted(set(list(range(0, length - tile_size, core)) + [length - tile_size]))
+    keep = [(0 if s == 0 else s + overlap, length if s + tile_size == length else s + tile_size - overlap) for s in starts]
+    return tile_size, starts, keep
+
+
+def predict_tiled(model, image, tile_size, batch_size=1, device='cpu', overlap=RECEPTIVE_MARGIN):
+    """tiled inference of (n, 1, h, w) images, activation memory is bounded by `batch_size` tiles whatever the image size
+
+    Tiles overlap by `overlap` pixels on each side and only each tile's central part is kept, with `overlap` at least
+    the network's receptive field margin this gives the same result as whole image inference.
+    """
+    assert overlap >= RECEPTIVE_MARGIN, f'overlap must be at least the receptive field margin of {RECEPTIVE_MARGIN} pixels'
+    n_images, _, h, w = image.shape
+    tile_h, rows, row_keep = tile_starts(h, tile_size, overlap)
+    tile_w, cols, col_keep = tile_starts(w, tile_size, overlap)
+    tiles = [(n, r, c) for n in range(n_images) for r in range(len(rows)) for c in range(len(cols))]
+    pred = np.zeros_like(image)
+    image = torch.tensor(image, device=device)
+    with torch.no_grad():
+        for b in tqdm(range(0, len(tiles), batch_size)):
+            batch = tiles[b:b+batch_size]
+            x = torch.stack([image[n, :, rows[r]:rows[r]+tile_h, cols[c]:cols[c]+tile_w] for n, r, c in batch])
+            out = model(x).to('cpu').numpy()
+            for t, (n, r, c) in enumerate(batch):
+                (r0, r1), (c0, c1) = row_keep[r], col_keep[c]
+                pred[n, :, r0:r1, c0:c1] = out[t, :, r0-rows[r]:r1-rows[r], c0-cols[c]:c1-cols[c]]
+    return pred
+
+
+def export_model(model, f, device='cpu'):
+    """compiles a trained model with its normalize and denormalize steps into an AOTInductor package `f`
+    (e.g. REDCNN_{iter}iter.pt2) with dynamic batch and image size, load it with `load_exported_model`"""
+    model = model.to(device).eval()
+    example = torch.zeros(2, 1, 128, 128, device=device)
+    batch = torch.export.Dim('batch')
+    height = torch.export.Dim('height', min=22) # 5 convolutions of kernel 5 take 20 pixels off each side
+    width = torch.export.Dim('width', min=22)
+    with torch.no_grad():
+        exported = torch.export.export(model, (example,), dynamic_shapes=({0: batch, 2: height, 3: width},))
+    return torch._inductor.aoti_compile_and_package(exported, package_path=str(f))
+
+
+def load_exported_model(f):
+    # a package only runs on the device it was compiled for (export.py --device), recorded as `model.device`
+    model = torch._inductor.aoti_load_package(str(f))
+    model.device = torch.device(model.get_metadata()['AOTI_DEVICE_KEY'])
+    if (model.device.type == 'cuda') and not torch.cuda.is_available():
+        raise RuntimeError(f'{f} was compiled for {model.device} but no GPU is available, re-export it with --device cpu')
+    return model
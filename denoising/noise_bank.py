@@ -0,0 +1,125 @@
+import os
+import json
+import hashlib
+from pathlib import Path
+import numpy as np
+import torch
+
+
+class HistogramMatcher(object):
+    """Histogram matching to a fixed reference, equivalent to `skimage.exposure.match_histograms`
+
+    The reference quantiles are computed once, and since noise patches are integer HU each call
+    maps its input through a lookup table built from a `bincount` instead of sorting the input.
+    """
+    def __init__(self, ref_images):
+        ref_values, ref_counts = np.unique(np.asarray(ref_images).ravel(), return_counts=True)
+        self.ref_values = ref_values.astype(np.float64)
+        self.ref_quantiles = np.cumsum(ref_counts) / ref_counts.sum()
+
+    def __call__(self, images):
+        images = np.asarray(images).astype(np.int64)
+        vmin = images.min()
+        counts = np.bincount((images - vmin).ravel())
+        quantiles = np.cumsum(counts) / images.size
+        lut = np.interp(quantiles, self.ref_quantiles, self.ref_values)
+        return lut[images - vmin]
+
+
+def match_noise_patches(noise_patches, matcher):
+    # histogram match to the training noise then remove the DC bias introduced by the histogram matching
+    equal_hist_patches = matcher(noise_patches)
+    equal_hist_patches = equal_hist_patches - equal_hist_patches.mean()
+    return equal_hist_patches.astype('int16')
+
+
+def atomic_write(f, write):
+    # write(fid) goes to a temporary file renamed over f, so concurrent jobs never read a partially written file
+    f = Path(f)
+    tmp = f.with_name('{}.{}.tmp'.format(f.name, os.getpid()))
+    with open(tmp, 'wb') as fid:
+        write(fid)
+    os.replace(tmp, f)
+
+
+def file_hash(f, cache_dir):
+    # sha1 of the file contents, memoized in cache_dir/hashes.json on (size, mtime) so unchanged files are hashed once
+    f = Path(f).resolve()
+    memo_file = Path(cache_dir) / 'hashes.json'
+    memo = json.loads(memo_file.read_text()) if memo_file.exists() else {}
+    stat = f.stat()
+    entry = memo.get(str(f))
+    if entry and (entry['size'] == stat.st_size) and (entry['mtime'] == stat.st_mtime):
+        return entry['sha1']
+    sha1 = hashlib.sha1()
+    with open(f, 'rb') as fid:
+        for chunk in iter(lambda: fid.read(1 << 24), b''):
+            sha1.update(chunk)
+    memo[str(f)] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': sha1.hexdigest()}
+    atomic_write(memo_file, lambda fid: fid.write(json.dumps(memo, indent=1).encode()))
+    return sha1.hexdigest()
+
+
+def noise_cache_file(cache_dir, noise_files, n_patches, ref_images):
+    """content-addressed cache file for histogram matched noise patches
+
+    The key combines the noise patch file hashes, the number of patches and the reference noise
+    statistics (std and percentiles rounded to whole HU), the reference being a fixed seeded set of
+    training patches (see `Solver.reference_batch`).
+    """
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    ref_stats = np.round([ref_images.std(), *np.percentile(ref_images, [1, 5, 25, 50, 75, 95, 99])]).astype(int).tolist()
+    key = {'files': [file_hash(f, cache_dir) for f in noise_files], 'n_patches': n_patches, 'ref_stats': ref_stats}
+    return cache_dir / '{}.npy'.format(hashlib.sha1(json.dumps(key).encode()).hexdigest())
+
+
+class NoisePatchBank(object):
+    """Bounded ring buffer of noise patches streamed from memory-mapped `diameter{d}mm.npy` files
+
+    Each refresh draws an equal number of random patches from every file, so over training
+    the whole of every file is sampled while only `bank_size` patches are ever held in memory.
+    """
+    def __init__(self, noise_files, bank_size=3000, device='cpu', transform=None, rng=None):
+        self.noise_files = noise_files
+        self.noise_maps = [np.load(f, mmap_mode='r') for f in noise_files]
+        self.bank_size = bank_size - bank_size % len(noise_files) # equal share per diameter
+        self.patches = torch.zeros((self.bank_size, *self.noise_maps[0].shape[1:]), dtype=torch.float32, device=device)
+        self.transform = transform
+        self.rng = rng or np.random.default_rng()
+        self.cursor = 0
+
+    def __len__(self):
+        return self.bank_size
+
+    def read(self, n):
+        # n random patches per file, read in sorted order to keep the memory-mapped reads sequential
+        # the transform (histogram matching and DC removal) always sees a block of at least a full bank share per file,
+        # so small refreshes are matched with the same statistics as the initial fill before n are kept
+        block = max(n, self.bank_size // len(self.noise_maps))
+        patches = []
+        for noise_map in self.noise_maps:
+            idx = np.sort(self.rng.choice(len(noise_map), min(block, len(noise_map)), replace=False))
+            noise_patches = np.asarray(noise_map[idx]).astype('int16')
+            if self.transform:
+                noise_patches = self.transform(noise_patches)
+            keep = self.rng.choice(len(noise_patches), min(n, len(noise_patches)), replace=False)
+            patches.append(noise_patches[keep])
+        return np.concatenate(patches)
+
+    def refresh(self, n):
+        # overwrite the oldest n patches in the ring buffer with newly streamed ones
+        n_per_file = max(n // len(self.noise_maps), 1)
+        patches = torch.from_numpy(self.read(n_per_file)).to(self.patches)[:self.bank_size]
+        idx = (self.cursor + torch.arange(len(patches), device=self.patches.device)) % self.bank_size
+        self.patches[idx] = patches
+        self.cursor = (self.cursor + len(patches)) % self.bank_size
+
+    def fill(self):
+        self.refresh(self.bank_size)
+
+    def save(self, f):
+        atomic_write(f, lambda fid: np.save(fid, self.patches.cpu().numpy().astype('int16')))
+
+    def load(self, f):
+        self.patches[:] = torch.from_numpy(np.load(f)).to(self.patches)
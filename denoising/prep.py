@@ -1,8 +1,12 @@
 import os
+import json
 import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 import pydicom
 
+STORE_INDEX = 'index.json'
+
 
 def save_dataset(args):
     if not os.path.exists(args.save_path):
@@ -10,24 +14,56 @@ def save_dataset(args):
         print('Create path : {}'.format(args.save_path))
 
     patients_list = sorted([d for d in os.listdir(args.data_path) if 'zip' not in d])
-    for p_ind, patient in enumerate(patients_list):
-        patient_input_path = os.path.join(args.data_path, patient,
-                                          "quarter_{}mm".format(args.mm))
-        patient_target_path = os.path.join(args.data_path, patient,
-                                           "full_{}mm".format(args.mm))
-
-        for path_ in [patient_input_path, patient_target_path]:
-            full_pixels = get_pixels_hu(load_scan(path_))
-            for pi in range(len(full_pixels)):
-                io = 'input' if 'quarter' in path_ else 'target'
-                f = full_pixels[pi] # f = normalize_(full_pixels[pi], args.norm_range_min, args.norm_range_max)
-                f_name = '{}_{}_{}.npy'.format(patient, pi, io)
-                np.save(os.path.join(args.save_path, f_name), f)
-
-        printProgressBar(p_ind, len(patients_list),
-                         prefix="save image ..",
-                         suffix='Complete', length=25)
-        print(' ')
+    series = {}
+    for patient in patients_list:
+        series[patient, 'input'] = os.path.join(args.data_path, patient, "quarter_{}mm".format(args.mm))
+        series[patient, 'target'] = os.path.join(args.data_path, patient, "full_{}mm".format(args.mm))
+
+    # each patient's quarter and full dose series are read in parallel, a volume is saved once both are done
+    # futures are popped as they complete so a series is freed once its volume is written
+    n_slices = {}
+    pending = {}
+    with ProcessPoolExecutor(args.num_workers) as pool:
+        futures = {pool.submit(load_series_hu, path): key for key, path in series.items()}
+        for future in as_completed(futures):
+            patient, io = futures.pop(future)
+            pending.setdefault(patient, {})[io] = future.result()
+            if len(pending[patient]) < 2:
+                continue
+            pixels = pending.pop(patient)
+            n_slices[patient] = save_volume(os.path.join(args.save_path, '{}.npy'.format(patient)),
+                                            pixels['input'], pixels['target'])
+
+            printProgressBar(len(n_slices), len(patients_list),
+                             prefix="save image ..",
+                             suffix='Complete', length=25)
+            print(' ')
+
+    index = []
+    offset = 0
+    for patient in patients_list:
+        index.append({'patient': patient, 'file': '{}.npy'.format(patient),
+                      'offset': offset, 'n_slices': n_slices[patient]})
+        offset += n_slices[patient]
+    with open(os.path.join(args.save_path, STORE_INDEX), 'w') as f:
+        json.dump(index, f, indent=1)
+
+
+def save_volume(f_name, input_pixels, target_pixels):
+    # one contiguous (2, slices, h, w) int16 volume per patient, [0] is input (quarter dose) and [1] is target (full dose)
+    assert input_pixels.shape == target_pixels.shape, 'input and target series differ in shape'
+    volume = np.lib.format.open_memmap(f_name, mode='w+', dtype=np.int16,
+                                       shape=(2, *input_pixels.shape))
+    volume[0] = input_pixels
+    volume[1] = target_pixels
+    volume.flush()
+    del volume
+    return len(input_pixels)
+
+
+def load_store_index(saved_path):
+    with open(os.path.join(saved_path, STORE_INDEX)) as f:
+        return json.load(f)
 
 
 def load_scan(path):
@@ -43,19 +79,28 @@ def load_scan(path):
     return slices
 
 
+def load_series_hu(path):
+    # sorts on header tags only, then decodes the pixel data in slice order
+    headers = [pydicom.dcmread(os.path.join(path, s), stop_before_pixels=True,
+                               specific_tags=['ImagePositionPatient', 'SliceLocation', 'RescaleIntercept', 'RescaleSlope'])
+               for s in os.listdir(path)]
+    headers.sort(key=lambda x: float(x.ImagePositionPatient[2]))
+    return get_pixels_hu([pydicom.dcmread(s.filename) for s in headers])
+
+
 def get_pixels_hu(slices):
     # referred from https://www.kaggle.com/gzuidhof/full-preprocessing-tutorial
-    image = np.stack([s.pixel_array for s in slices])
-    image = image.astype(np.int16)
+    # vectorized: pixels are written into one preallocated int16 volume and rescaled in place
+    image = np.empty((len(slices), *slices[0].pixel_array.shape), dtype=np.int16)
+    for slice_number, s in enumerate(slices):
+        image[slice_number] = s.pixel_array
     image[image == -2000] = 0
-    for slice_number in range(len(slices)):
-        intercept = slices[slice_number].RescaleIntercept
-        slope = slices[slice_number].RescaleSlope
-        if slope != 1:
-            image[slice_number] = slope * image[slice_number].astype(np.float64)
-            image[slice_number] = image[slice_number].astype(np.int16)
-        image[slice_number] += np.int16(intercept)
-    return np.array(image, dtype=np.int16)
+    slopes = np.array([float(s.RescaleSlope) for s in slices])
+    intercepts = np.array([np.int16(s.RescaleIntercept) for s in slices], dtype=np.int16)
+    if np.any(slopes != 1): # computed in float64 and truncated to int16 in buffered chunks
+        np.multiply(image, slopes[:, None, None], out=image, casting='unsafe')
+    np.add(image, intercepts[:, None, None], out=image, casting='unsafe')
+    return image
 
 
 def normalize_(image, MIN_B=-1024.0, MAX_B=3072.0):
@@ -81,6 +126,7 @@ if __name__ == "__main__":
 
     parser.add_argument('--test_patient', type=str, default='L506')
     parser.add_argument('--mm', type=int, default=3)
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count(), help='processes reading DICOM series in parallel')
     parser.add_argument('--norm_range_min', type=float, default=-1024.0)
     parser.add_argument('--norm_range_max', type=float, default=3072.0)
 
@@ -5,7 +5,6 @@ import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 from collections import OrderedDict
-from skimage.exposure import match_histograms
 
 import torch
 import torch.nn as nn
@@ -14,6 +13,8 @@ import torch.optim as optim
 from prep import printProgressBar
 from networks import RED_CNN
 from measure import compute_measure
+from loader import get_patches
+from noise_bank import NoisePatchBank, HistogramMatcher, match_noise_patches, noise_cache_file
 
 from pathlib import Path
 
@@ -44,18 +45,30 @@ class Solver(object):
         self.result_fig = args.result_fig
 
         self.patch_size = args.patch_size
+        self.patch_n = args.patch_n
+        self.crop_on_device = args.crop_on_device or args.resident
+        self.resident = args.resident and (self.mode == 'train')
+        self.noise_lambda_min = args.noise_lambda_min
+        self.noise_lambda_max = args.noise_lambda_max
+        self.noise_bank_refresh = args.noise_bank_refresh
+        self.amp = args.amp
 
         self.REDCNN = RED_CNN()
         if (self.multi_gpu) and (torch.cuda.device_count() > 1):
             print('Use {} GPUs'.format(torch.cuda.device_count()))
             self.REDCNN = nn.DataParallel(self.REDCNN)
         self.REDCNN.to(self.device)
+        if self.amp: # bfloat16 autocast with channels_last activations, weights and checkpoints stay fp32
+            self.REDCNN.to(memory_format=torch.channels_last)
         print(self.device)
 
         self.lr = args.lr
         self.criterion = nn.MSELoss()
         self.optimizer = optim.Adam(self.REDCNN.parameters(), self.lr)
 
+        if self.resident: # before the noise setup so its reference batch comes from the resident slices
+            self.load_resident()
+
         if args.augment:
             print('Loading noise patches for augmentation...')
             # prep for augmentation
@@ -63,32 +76,79 @@ class Solver(object):
             diameters = [112, 131, 151, 185, 216, 292]
 
             noise_files = [noise_patch_dir / f'diameter{d}mm.npy' for d in diameters]
-            noise_patches = 500 # <-- experiment with how many to include (too many to load all 30,000/diameter)
-            noise_patch_dict = {f.stem: np.load(f)[:noise_patches].astype('int16') for f in noise_files}
-            input_shape = noise_patch_dict['diameter292mm'].shape
-
-            i = 0
-            for x, y in self.data_loader:
-                i += 1
-                if i > 0:
-                    break
+            # patches are memory-mapped and streamed into a bank of noise_bank_size (too many to load all 30,000/diameter)
+            self.noise_bank = NoisePatchBank(noise_files, args.noise_bank_size, device=self.device)
+
+            x, y = self.reference_batch()
             train_noise = x - y
             ref_images = train_noise.reshape(-1, 1).numpy()
-            equal_hist_patches = {diam: match_histograms(input_images.reshape(-1, 1), reference=ref_images).reshape(input_shape) for diam, input_images in noise_patch_dict.items()}
-            equal_hist_patches = {diam: p - p.mean() for diam, p in equal_hist_patches.items()} # remove the DC bias introduced by the histogram matching
-            self.noise_patches = torch.tensor(np.concatenate(list(equal_hist_patches.values())).astype('int16'), device=self.device)
+            matcher = HistogramMatcher(ref_images)
+            self.noise_bank.transform = lambda noise_patches: match_noise_patches(noise_patches, matcher)
+            cache_file = noise_cache_file(args.noise_cache_dir or noise_patch_dir / 'cache', noise_files, len(self.noise_bank), ref_images)
+            if cache_file.exists() and not args.rebuild_noise_cache:
+                print('loading histogram matched noise patches from {}'.format(cache_file))
+                self.noise_bank.load(cache_file)
+            else:
+                self.noise_bank.fill()
+                self.noise_bank.save(cache_file)
+            self.noise_patches = self.noise_bank.patches
             print('noise patch loading complete.')
 
+    def reference_batch(self, seed=0):
+        # a fixed, seeded batch of training slices and patch offsets, so the histogram matching reference and
+        # the noise cache key derived from it are the same every run
+        dataset = self.data_loader.dataset
+        rng = np.random.default_rng(seed)
+        idx = np.sort(rng.choice(len(dataset), min(self.data_loader.batch_size, len(dataset)), replace=False))
+        if self.resident:
+            slices = [(self.inputs[i].cpu().numpy(), self.targets[i].cpu().numpy()) for i in idx]
+        else:
+            slices = [dataset.get_slice(i) for i in idx]
+        patches = [get_patches(x, y, self.patch_n, self.patch_size, rng) for x, y in slices] if self.patch_size else slices
+        x = torch.from_numpy(np.stack([p[0] for p in patches]).astype(np.float32))
+        y = torch.from_numpy(np.stack([p[1] for p in patches]).astype(np.float32))
+        return x, y
+
     def augment(self, image_label, aug_thresh=0.35):
+        # per-sample decisions: each patch is augmented with probability aug_thresh using its own noise patch and noise_lambda
         image, label = image_label
-        noise_patch = self.noise_patches[torch.randperm(len(image))].reshape_as(image)
-        noise_lambda = 1 # torch.rand([1])[0].item() # adds a random amount of noise, consider ablating to see affect with and without this (seems similar to the noise level augmentation which was generally beneficial whereas having it off would be just augmenting with a single noise level (equal to quarter dose but with different texture))
-        add_noise = torch.rand([1])[0].item() < aug_thresh #from 0.5
-
-        if add_noise:
-            image = label + noise_lambda*noise_patch
+        n = len(image)
+        noise_patch = self.noise_patches[torch.randint(len(self.noise_patches), (n,), device=self.device)].view_as(image)
+        noise_lambda = torch.empty((n, 1, 1, 1), device=self.device).uniform_(self.noise_lambda_min, self.noise_lambda_max) # noise_lambda_min = noise_lambda_max = 1 adds a single noise level (equal to quarter dose but with different texture)
+        add_noise = torch.rand((n, 1, 1, 1), device=self.device) < aug_thresh
+        image = torch.where(add_noise, torch.addcmul(label, noise_lambda, noise_patch), image)
         return image, label
 
+    def crop_patches(self, x, y):
+        # same sampling as loader.get_patches but as one batched gather on the device, patch_n crops per slice
+        x = x.to(self.device, non_blocking=True)
+        y = y.to(self.device, non_blocking=True)
+        b, h, w = x.shape
+        top = torch.randint(0, h - self.patch_size, (b, self.patch_n, 1, 1), device=self.device)
+        left = torch.randint(0, w - self.patch_size, (b, self.patch_n, 1, 1), device=self.device)
+        offsets = torch.arange(self.patch_size, device=self.device)
+        idx = ((top + offsets.view(-1, 1))*w + left + offsets).view(b, -1)
+        x = torch.gather(x.view(b, -1), 1, idx).view(-1, 1, self.patch_size, self.patch_size).float()
+        y = torch.gather(y.view(b, -1), 1, idx).view(-1, 1, self.patch_size, self.patch_size).float()
+        return x, y
+
+    def load_resident(self):
+        # stack every slice once into two contiguous int16 tensors on the device
+        assert self.load_mode == 1, 'resident training requires load_mode=1'
+        # the dataset's per-slice lists are replaced by the stacked arrays so only one host copy is kept
+        dataset = self.data_loader.dataset
+        dataset.input_ = np.stack(dataset.input_).astype(np.int16, copy=False)
+        dataset.target_ = np.stack(dataset.target_).astype(np.int16, copy=False)
+        self.inputs = torch.from_numpy(dataset.input_).to(self.device)
+        self.targets = torch.from_numpy(dataset.target_).to(self.device)
+        print('{} slices resident on {}'.format(len(self.inputs), self.device))
+
+    def resident_batches(self):
+        # index sampling over the resident slices, replaces iterating the DataLoader
+        perm = torch.randperm(len(self.inputs), device=self.device)
+        for idx in perm.split(self.data_loader.batch_size):
+            yield self.inputs[idx], self.targets[idx]
+
     def save_model(self, iter_):
         f = os.path.join(self.save_path, 'REDCNN_{}iter.ckpt'.format(iter_))
         torch.save(self.REDCNN.state_dict(), f)
@@ -149,23 +209,32 @@ class Solver(object):
         start_time = time.time()
         for epoch in range(1, self.num_epochs):
             self.REDCNN.train(True)
+            if augment and self.noise_bank_refresh and (epoch > 1):
+                self.noise_bank.refresh(self.noise_bank_refresh)
 
-            for iter_, (x, y) in enumerate(self.data_loader):
+            batches = self.resident_batches() if self.resident else self.data_loader
+            for iter_, (x, y) in enumerate(batches):
                 total_iters += 1
 
-                # add 1 channel
-                x = x.unsqueeze(0).float().to(self.device)
-                y = y.unsqueeze(0).float().to(self.device)
+                if self.crop_on_device:
+                    x, y = self.crop_patches(x, y)
+                else:
+                    # add 1 channel
+                    x = x.unsqueeze(0).float().to(self.device)
+                    y = y.unsqueeze(0).float().to(self.device)
 
-                if self.patch_size: # patch training
-                    x = x.view(-1, 1, self.patch_size, self.patch_size)
-                    y = y.view(-1, 1, self.patch_size, self.patch_size)
+                    if self.patch_size: # patch training
+                        x = x.view(-1, 1, self.patch_size, self.patch_size)
+                        y = y.view(-1, 1, self.patch_size, self.patch_size)
 
                 if augment: #conditional likely uneeded if lambda = 0, same effect
                     x, y = self.augment((x, y), augment)
 
-                pred = self.REDCNN(x)
-                loss = self.criterion(pred, y)
+                if self.amp:
+                    x = x.contiguous(memory_format=torch.channels_last)
+                with torch.autocast(device_type=self.device.type, dtype=torch.bfloat16, enabled=self.amp):
+                    pred = self.REDCNN(x)
+                loss = self.criterion(pred.float(), y)
                 self.REDCNN.zero_grad()
                 self.optimizer.zero_grad()
 
@@ -3,8 +3,12 @@
 # %%
 from pathlib import Path
 import numpy as np
-from itertools import combinations
+from itertools import combinations, islice
+from math import comb
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from numpy.lib.stride_tricks import sliding_window_view
+from numpy.lib.format import open_memmap
 
 import SimpleITK as sitk
 import pandas as pd
@@ -19,30 +23,82 @@ def write_mhd(array, fname): sitk.WriteImage(sitk.GetImageFromArray(array), fnam
 
 
 def make_noise_images(sa_images, max_images = 500):
-    noise_images = []
-    for count, image_idxs in enumerate(combinations(range(len(sa_images)), 2)):
-        if count < max_images:
-            noise_image = sa_images[image_idxs[1]] - sa_images[image_idxs[0]]
-            if noise_image.mean() > 100:
-                raise RuntimeError(f'Error in noise image at indices {image_idxs}. Mean: {noise_image.mean} > 100')
-            noise_images.append(noise_image)
-    noise_images = np.array(noise_images)
-    noise_images.reshape([*noise_images.shape, 1])
-    return noise_images
+    noise_images = list(iter_noise_images(sa_images, max_images=max_images))
+    if not noise_images:
+        return np.array([])
+    return np.concatenate(noise_images)
+
+
+def count_noise_images(sa_images, max_images=500):
+    return min(comb(len(sa_images), 2), max_images)
+
+
+def iter_noise_images(sa_images, max_images=500, chunk_size=100):
+    """yields the pairwise difference images of `make_noise_images` in blocks of up to `chunk_size`,
+    so peak memory is bounded by `chunk_size` rather than `max_images`"""
+    pairs = islice(combinations(range(len(sa_images)), 2), max_images)
+    while len(image_idxs := np.array(list(islice(pairs, chunk_size)), dtype=int).reshape(-1, 2)):
+        noise_images = sa_images[image_idxs[:, 1]] - sa_images[image_idxs[:, 0]]
+        means = noise_images.mean(axis=(1, 2))
+        if np.any(means > 100):
+            bad = np.argmax(means > 100)
+            raise RuntimeError(f'Error in noise image at indices {tuple(image_idxs[bad])}. Mean: {means[bad]} > 100')
+        yield noise_images
 
 
 def make_noise_patches(noise_images, patch_size=(30, 30), max_patches=30):
     return PatchExtractor(patch_size=patch_size, max_patches=max_patches).transform(noise_images)
 
 
-def make_noise_image_dict(datadir, dose=100, max_images=1000, kernel='fbp'):
+def extract_patches(noise_images, patch_size=(30, 30), max_patches=30, rng=None):
+    """vectorized `make_noise_patches`, draws `max_patches` random patch offsets per image (with replacement, as PatchExtractor)
+    and gathers them from a strided window view in one fancy index"""
+    rng = rng or np.random.default_rng()
+    n, h, w = noise_images.shape
+    top = rng.integers(0, h - patch_size[0] + 1, size=n*max_patches)
+    left = rng.integers(0, w - patch_size[1] + 1, size=n*max_patches)
+    image_idx = np.repeat(np.arange(n), max_patches)
+    return sliding_window_view(noise_images, patch_size, axis=(1, 2))[image_idx, top, left]
+
+
+def get_image_files(datadir, dose=100, kernel='fbp'):
     datadir = Path(datadir)
     meta = pd.read_csv(datadir / 'metadata.csv')
     diameters = sorted(meta[(meta.recon==kernel) & (meta.phantom == 'uniform')]['effective diameter (cm)'].unique())
-    sa_image_dict = dict()
-    for diameter in diameters:
-        image_filename = meta[(meta.recon==kernel) & (meta.phantom == 'uniform') & (meta['Dose [%]']==dose) & (meta['effective diameter (cm)'] == diameter)].file.item()
-        sa_image_dict[diameter] = load_mhd(datadir/image_filename)
+    return {diameter: datadir / meta[(meta.recon==kernel) & (meta.phantom == 'uniform') & (meta['Dose [%]']==dose) & (meta['effective diameter (cm)'] == diameter)].file.item()
+            for diameter in diameters}
+
+
+def save_diameter_patches(image_file, outfile, patch_size=(30,30), patches_per_image=30, max_images=1000, chunk_size=100, seed=None, dtype='int16'):
+    """makes the noise patches of one diameter and streams them, `chunk_size` noise images at a time, into a preallocated memory-mapped `outfile`"""
+    rng = np.random.default_rng(seed)
+    sa_images = load_mhd(image_file)
+    n_images = count_noise_images(sa_images, max_images=max_images)
+    patches = open_memmap(outfile, mode='w+', dtype=dtype, shape=(n_images*patches_per_image, *patch_size))
+    start = 0
+    for chunk in iter_noise_images(sa_images, max_images=max_images, chunk_size=chunk_size):
+        patches[start*patches_per_image:(start+len(chunk))*patches_per_image] = extract_patches(chunk, patch_size, patches_per_image, rng)
+        start += len(chunk)
+    patches.flush()
+    return outfile
+
+
+def prep_patches_parallel(datadir, noise_patch_dir, dose=100, patch_size=(30,30), patches_per_image=30, max_images=1000, num_workers=None, seed=None):
+    """`prep_patches` followed by `save_patches` with one process per diameter, returns the output files"""
+    image_files = get_image_files(datadir, dose=dose)
+    seeds = np.random.SeedSequence(seed).spawn(len(image_files))
+    print('extracting noise patches...')
+    with ProcessPoolExecutor(num_workers) as pool:
+        futures = [pool.submit(save_diameter_patches, image_file, Path(noise_patch_dir) / f'{k}.npy', patch_size, patches_per_image, max_images, seed=s)
+                   for (k, image_file), s in zip(image_files.items(), seeds)]
+        output_files = [f.result() for f in tqdm(futures)]
+    for outfile in output_files:
+        print(f'saved patches to {outfile}')
+    return output_files
+
+
+def make_noise_image_dict(datadir, dose=100, max_images=1000, kernel='fbp'):
+    sa_image_dict = {diameter: load_mhd(image_file) for diameter, image_file in get_image_files(datadir, dose=dose, kernel=kernel).items()}
     noise_image_dict = {k: make_noise_images(v, max_images=max_images) for k, v in sa_image_dict.items()}
     return noise_image_dict
 
@@ -70,6 +126,7 @@ if __name__ == '__main__':
     parser.add_argument('--data_path', type=str, default='data', help='directory containing images to be processed')
     parser.add_argument('--save_path', type=str, default='noise_patches', help='save directory for noise patches')
     parser.add_argument('--patch_size', type=int, default=30, help='side length of square patches to be extracted, e.g. patch_size=30 yields 30x30 patches')
+    parser.add_argument('--num_workers', type=int, default=None, help='processes extracting patches in parallel, one diameter each, defaults to all cores')
     args = parser.parse_args()
 
     datadir = args.data_path
@@ -79,5 +136,4 @@ if __name__ == '__main__':
         print(f'creating directory: {noise_patch_dir}')
         noise_patch_dir.mkdir(exist_ok=True, parents=True)
 
-    noise_patch_dict = prep_patches(datadir, patch_size=(patch_size, patch_size))
-    save_patches(noise_patch_dir, noise_patch_dict)
\ No newline at end of file
+    prep_patches_parallel(datadir, noise_patch_dir, patch_size=(patch_size, patch_size), num_workers=args.num_workers)
\ No newline at end of file
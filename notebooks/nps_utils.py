@@ -1,43 +1,102 @@
 from pathlib import Path
+from functools import lru_cache
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import numpy as np
 import pandas as pd
 import SimpleITK as sitk
+from scipy import fft
 
-from make_noise_patches import make_noise_images
+from make_noise_patches import iter_noise_images
 
 
-def compute_nps(image):
+def compute_nps(image, chunk_size=100, workers=None):
+  """noise power spectrum summed over realizations, see `accumulate_power` and `power_to_nps`
 
+  Args:
+    image (np.ndarray): noise image or images of shape (ny, nx), (n, ny, nx) or (n, ny, nx, 1)
+    chunk_size (int): number of realizations transformed at once
+    workers (int): `scipy.fft` worker threads, -1 for all cores
+  """
   if image.ndim == 2:
     image = image[None, :, :]
 
   if image.ndim == 4:
     image = image[:,:,:,0]
 
-  nsize = image.shape
-  nrealization = nsize[0]
-  if image.ndim == 3:
-    nps = np.zeros((nsize[1],nsize[2]))
-    for i in range(nrealization):
-      s = np.fft.fftshift(np.fft.fft2(image[i]))
-      nps = np.abs(s)**2 + nps
-    nps = nps/(nsize[1]*nsize[2])
-  else:
+  if image.ndim != 3:
     raise ValueError(f'Image of dimension {image.ndim} Not implemented!')
-  return nps
+  power = None
+  for start in range(0, len(image), chunk_size):
+    power = accumulate_power(image[start:start+chunk_size], power, workers=workers)
+  return power_to_nps(power, image.shape[1:])
 
 
-def radial_profile(data, center=None):
-    center = center or (data.shape[0]/2, data.shape[1]/2)
-    y, x = np.indices((data.shape))
-    r = np.sqrt((x - center[0])**2 + (y - center[1])**2)
-    r = r.astype(int)
+def accumulate_power(images, power=None, workers=None):
+  """adds the summed |rfft2|^2 of a chunk of realizations (n, ny, nx) into the half spectrum `power` (ny, nx//2+1) in place"""
+  s = fft.rfft2(images, workers=workers)
+  chunk_power = np.einsum('nij,nij->ij', s.real, s.real) + np.einsum('nij,nij->ij', s.imag, s.imag)
+  if power is None:
+    return chunk_power
+  power += chunk_power
+  return power
 
-    tbin = np.bincount(r.ravel(), data.ravel())
-    nr = np.bincount(r.ravel())
-    radialprofile = tbin / nr
-    return radialprofile
+
+def power_to_nps(power, shape):
+  """expands an accumulated rfft2 half spectrum to the full (ny, nx) spectrum by Hermitian symmetry,
+  fftshifts once and normalizes by the number of pixels, matching the `fft2` based NPS"""
+  ny, nx = shape
+  nps = np.empty((ny, nx))
+  nps[:, :power.shape[1]] = power
+  neg_rows = -np.arange(ny) % ny
+  neg_cols = nx - np.arange(power.shape[1], nx)
+  nps[:, power.shape[1]:] = power[neg_rows][:, neg_cols]
+  return np.fft.fftshift(nps)/(ny*nx)
+
+
+class RadialBins(object):
+    """Precomputed radial binning of (ny, nx) maps, see `get_radial_bins` for the cached constructor
+
+    Args:
+      shape (tuple): (ny, nx) of the maps to bin
+      center (tuple): (x, y) center, defaults to (shape[0]/2, shape[1]/2) as in `radial_profile`
+      bin_width (float): bin width, may be fractional, in pixels or in frequency units if `pixel_size` is given
+      pixel_size (float): image pixel size, if given radii are spatial frequencies in cycles per unit of `pixel_size`
+    """
+    def __init__(self, shape, center=None, bin_width=1, pixel_size=None):
+        self.shape = tuple(shape)
+        center = center or (shape[0]/2, shape[1]/2)
+        y, x = np.indices(self.shape)
+        dx, dy = x - center[0], y - center[1]
+        if pixel_size is not None: # map pixel offsets of the shifted spectrum to frequencies
+            dx, dy = dx/(shape[1]*pixel_size), dy/(shape[0]*pixel_size)
+        r = np.sqrt(dx**2 + dy**2)
+        self.index = (r / bin_width).astype(int).ravel()
+        self.nbins = self.index.max() + 1
+        self.counts = np.bincount(self.index, minlength=self.nbins)
+        self.radii = bin_width*np.arange(self.nbins)
+
+    def __call__(self, data):
+        """mean of `data` (..., ny, nx) in each radial bin, returns (..., nbins)"""
+        data = np.asarray(data)
+        maps = data.reshape(-1, self.index.size)
+        idx = (self.index + self.nbins*np.arange(len(maps))[:, None]).ravel() # offset each map into its own bins
+        tbin = np.bincount(idx, maps.ravel(), minlength=len(maps)*self.nbins).reshape(len(maps), self.nbins)
+        with np.errstate(invalid='ignore'):
+            profiles = tbin / self.counts
+        return profiles.reshape(*data.shape[:-2], self.nbins)
+
+
+@lru_cache(maxsize=32)
+def get_radial_bins(shape, center=None, bin_width=1, pixel_size=None):
+    return RadialBins(shape, center, bin_width, pixel_size)
+
+
+def radial_profile(data, center=None, bin_width=1, pixel_size=None):
+    """radially averaged profile of one (ny, nx) map or a stack (..., ny, nx), using cached `RadialBins`"""
+    center = tuple(center) if center else None
+    return get_radial_bins(np.shape(data)[-2:], center, bin_width, pixel_size)(data)
 
 
 def get_mean_nps(profile, freq=None):
@@ -67,13 +126,42 @@ def make_delta_df(noise_df, measurement='std', ref_recon='fbp'):
     return temp_experiment
 
 
-def make_results_dict(summary, max_images=2000, verbose=True, diameters=None, doses=None, recons=None):
+def compute_results(filename, max_images=2000, chunk_size=100, workers=None):
+    """NPS, radial profile and noise std of one signal absent volume, with its first image and noise image for plotting
+
+    Only these compact outputs are returned, so it can run in a worker process of `make_results_dict`
+    """
+    img = sitk.ReadImage(filename)
+    x, y, z = img.GetWidth(), img.GetHeight(), img.GetDepth()
+    vol = sitk.GetArrayFromImage(img).reshape(z, x, y)
+
+    vol = np.squeeze(vol).astype('int16')
+    # noise images are streamed in chunks, NPS power and std are accumulated so peak memory is bounded by chunk_size not max_images
+    power, std, noise_image = None, [], None
+    for noise_images in iter_noise_images(vol, max_images=max_images, chunk_size=chunk_size):
+        power = accumulate_power(noise_images, power, workers=workers)
+        std.append(noise_images.std(axis=(1,2)))
+        if noise_image is None:
+            noise_image = np.copy(noise_images[0]) #<- explicit copy so the chunk is not kept alive
+    nps = power_to_nps(power, vol.shape[1:])
+    return {'image': np.copy(vol[0]), 'noise image': noise_image, 'nps': nps, 'profile': radial_profile(nps), 'std': np.concatenate(std)}
+
+
+def make_results_dict(summary, max_images=2000, verbose=True, diameters=None, doses=None, recons=None, chunk_size=100, workers=None,
+                      num_workers=None, results_dir=None):
     """Makes images based measures of nps, std, and keeping select images for later plotting and saves them as a dict for quick access later
 
+    Each diameter, dose and recon combination is a `compute_results` task run in a pool of `num_workers` processes
+
     Args:
       summary (pd.DataFrame): DataFrame containing columns for diameter, dose, and recons as well as filenames pointing to raw image files.
       max_images (int):  upper bound on the image combinations made for generating `noise_images`
       verbose (bool): whether to print progress results
+      chunk_size (int): number of noise images held in memory at once
+      workers (int): `scipy.fft` worker threads for the NPS of each task, -1 for all cores
+      num_workers (int): processes running tasks in parallel, defaults to all cores
+      results_dir (str): optional `ResultsStore` directory, combinations already stored from unchanged files are lazily loaded
+        from it instead of recomputed and new ones (e.g. a new recon) are added to it
 
     Returns:
       dict
@@ -82,74 +170,159 @@ def make_results_dict(summary, max_images=2000, verbose=True, diameters=None, do
     doses = doses or sorted(summary[summary['diameter [mm]']!=200]['dose [%]'].unique())
     recons = recons or summary.recon.unique()
 
-    N = len(diameters)*len(doses)*len(recons)
-    idx = 0
+    filenames = summary.groupby(['diameter [mm]', 'dose [%]', 'recon']).filename.agg(list)
+    tasks = [(diameter, dose, recon) for diameter in diameters for dose in doses for recon in recons]
+    store = ResultsStore(results_dir) if results_dir else None
+    mtimes = {task: max(Path(f).stat().st_mtime for f in filenames[task]) for task in tasks} if store else {}
+    todo = [task for task in tasks if not (store and store.is_current(task, mtimes[task], max_images))]
+    N = len(todo)
+    results = dict()
+    with ProcessPoolExecutor(num_workers) as pool:
+        futures = {pool.submit(compute_results, [str(f) for f in filenames[task]], max_images, chunk_size, workers): task for task in todo}
+        for idx, future in enumerate(as_completed(futures), start=1):
+            diameter, dose, recon = task = futures[future]
+            results[task] = future.result()
+            if store: store.put(task, results[task], mtimes[task], max_images)
+            if verbose & (idx % 10 == 0): print(f'[{idx:03d}/{N:03d}] Made NPS and noise measures on: {diameter}mm, {dose} dose, {recon}')
+
     results_dict = dict()
-    for diameter in diameters:
-        results_dict[diameter] = dict()
-        for dose in doses:
-            results_dict[diameter][dose] = dict()
-            for recon in recons:
-                idx += 1
-                f = summary[(summary['diameter [mm]'] == diameter) & (summary.recon == recon) & (summary['dose [%]']==dose)].filename
-                if verbose & (idx % 10 == 0): print(f'[{idx:03d}/{N:03d}] Making NPS and noise measures on: {diameter}mm, {dose} dose, {recon}')
-
-                img = sitk.ReadImage(f)
-                x, y, z = img.GetWidth(), img.GetHeight(), img.GetDepth()
-                vol = sitk.GetArrayFromImage(img).reshape(z, x, y)
-
-                vol = np.squeeze(vol).astype('int16')
-                results_dict[diameter][dose][recon] = dict()
-                noise_images = make_noise_images(vol, max_images=max_images)
-                nps = compute_nps(noise_images)
-                std = noise_images.std(axis=(1,2)) 
-                nps_profile = radial_profile(nps)
-                results_dict[diameter][dose][recon]['image'] = np.copy(vol[0])
-                results_dict[diameter][dose][recon]['noise image'] = np.copy(noise_images[0]) #<- important to make an explicit copy of this view or else numpy keeps the 2000x512x512 array for every dose, recon combo and we quickly run out of memory and crash!
-                results_dict[diameter][dose][recon]['nps'] = nps
-                results_dict[diameter][dose][recon]['profile'] = nps_profile
-                results_dict[diameter][dose][recon]['std'] = std
+    for diameter, dose, recon in tasks:
+        result = results.get((diameter, dose, recon)) or store.get((diameter, dose, recon))
+        results_dict.setdefault(diameter, dict()).setdefault(dose, dict())[recon] = result
     return results_dict
 
 
+RESULT_FIELDS = ['image', 'noise image', 'nps', 'profile', 'std']
+INDEX_COLUMNS = ['diameter [mm]', 'dose [%]', 'recon', 'path', 'source mtime', 'max images']
+try:
+    import pyarrow # parquet engine for the store index, csv otherwise
+    INDEX_FILE = 'index.parquet'
+except ImportError:
+    INDEX_FILE = 'index.csv'
+
+
+class LazyResult(Mapping):
+    """One diameter, dose and recon entry of a `ResultsStore`, each field is memory-mapped from its .npy when accessed"""
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def __getitem__(self, field):
+        if field not in RESULT_FIELDS:
+            raise KeyError(field)
+        return np.load(self.path / f'{field.replace(" ", "_")}.npy', mmap_mode='r')
+
+    def __iter__(self):
+        return iter(RESULT_FIELDS)
+
+    def __len__(self):
+        return len(RESULT_FIELDS)
+
+
+class ResultsStore(object):
+    """On-disk `make_results_dict` results, a directory of .npy fields per (diameter, dose, recon) key and an index table
+
+    Entries are added or replaced one key at a time, so a new recon only adds its own keys, and are read lazily with
+    `get` or `to_dict`, so figures only load the arrays they plot.
+    """
+    def __init__(self, results_dir):
+        self.results_dir = Path(results_dir)
+        self.results_dir.mkdir(parents=True, exist_ok=True)
+        index_files = sorted(self.results_dir.glob('index.*'), key=lambda f: f.suffix != Path(INDEX_FILE).suffix)
+        if index_files:
+            index = pd.read_parquet(index_files[0]) if index_files[0].suffix == '.parquet' else pd.read_csv(index_files[0])
+        else:
+            index = pd.DataFrame(columns=INDEX_COLUMNS)
+        self.rows = {(d, dx, r): row for d, dx, r, *row in index[INDEX_COLUMNS].itertuples(index=False)}
+
+    def __contains__(self, key):
+        return tuple(key) in self.rows
+
+    def keys(self):
+        return list(self.rows)
+
+    def is_current(self, key, source_mtime, max_images):
+        # stored from the same source file version and number of noise images
+        row = self.rows.get(tuple(key))
+        return (row is not None) and (row[1] == source_mtime) and (row[2] == max_images)
+
+    def get(self, key):
+        path, _, _ = self.rows[tuple(key)]
+        return LazyResult(self.results_dir / path)
+
+    def put(self, key, result, source_mtime=np.nan, max_images=np.nan):
+        diameter, dose, recon = key
+        path = Path(f'diameter{diameter}mm') / f'dose_{dose:03d}' / recon
+        (self.results_dir / path).mkdir(parents=True, exist_ok=True)
+        for field in RESULT_FIELDS:
+            np.save(self.results_dir / path / f'{field.replace(" ", "_")}.npy', result[field])
+        self.rows[tuple(key)] = [str(path), source_mtime, max_images]
+        self.write_index()
+
+    def write_index(self):
+        index = pd.DataFrame([[*key, *row] for key, row in self.rows.items()], columns=INDEX_COLUMNS)
+        index_file = self.results_dir / INDEX_FILE
+        index.to_parquet(index_file, index=False) if index_file.suffix == '.parquet' else index.to_csv(index_file, index=False)
+
+    def to_dict(self, keys=None):
+        """nested diameter, dose, recon dict of `LazyResult`s in the `make_results_dict` format"""
+        results_dict = dict()
+        for diameter, dose, recon in (keys or self.keys()):
+            results_dict.setdefault(diameter, dict()).setdefault(dose, dict())[recon] = self.get((diameter, dose, recon))
+        return results_dict
+
+
+def save_results(results_dict, results_dir):
+    """Adds a nested `make_results_dict` results dict to the `ResultsStore` at `results_dir`"""
+    store = ResultsStore(results_dir)
+    for d in results_dict:
+        for dx in results_dict[d]:
+            for r in results_dict[d][dx]:
+                store.put((d, dx, r), results_dict[d][dx][r])
+    return store
+
+
+def load_results(results_dir, keys=None):
+    """Lazily loads the `ResultsStore` at `results_dir`, or only its (diameter, dose, recon) `keys`, in the nested `make_results_dict` format"""
+    return ResultsStore(results_dir).to_dict(keys)
+
+
 def get_summary(datadir):
     datadir = Path(datadir)
     sa_filenames = list(datadir.rglob('signal_absent.mhd'))
     return pd.concat([get_info(f) for f in sa_filenames], ignore_index=True)
 
 
-def append_mean_nps_to_summary_dataframe(results_dict, summary):
-    for diam in results_dict.keys():
-        for dose in results_dict[diam].keys():
-            for recon in results_dict[diam][dose].keys():
-                profile = results_dict[diam][dose][recon]['profile']
-                mean_nps = get_mean_nps(profile)
-                summary.loc[(summary['diameter [mm]'] == diam) & (summary['dose [%]'] == dose) &(summary.recon==recon), 'Mean NPS'] = mean_nps
+SUMMARY_KEYS = ['diameter [mm]', 'dose [%]', 'recon']
+
+
+def result_keys(results_dict):
+    return [(d, dx, r) for d in results_dict for dx in results_dict[d] for r in results_dict[d][dx]]
+
+
+def attach_to_summary(summary, values, column):
+    # sets `column` on the summary rows matching the (diameter, dose, recon) MultiIndex of `values`, other rows are left as they were
+    matched = summary[SUMMARY_KEYS].join(values.rename(column), on=SUMMARY_KEYS)[column]
+    summary[column] = matched.combine_first(summary[column]) if column in summary else matched
     return summary
 
 
+def append_mean_nps_to_summary_dataframe(results_dict, summary):
+    keys = result_keys(results_dict)
+    mean_nps = [get_mean_nps(results_dict[d][dx][r]['profile']) for d, dx, r in keys]
+    return attach_to_summary(summary, pd.Series(mean_nps, index=pd.MultiIndex.from_tuples(keys, names=SUMMARY_KEYS)), 'Mean NPS')
+
+
 def make_noise_dataframe(results_dict):
-    recon = []
-    diameter = []
-    dose = []
-    std = []
-    for d in results_dict.keys():
-        for dx in results_dict[d].keys():
-            for r in results_dict[d][dx].keys():
-                for s in results_dict[d][dx][r]['std']:
-                    diameter.append(d)
-                    dose.append(dx)
-                    recon.append(r)
-                    std.append(s)
-    return pd.DataFrame({'diameter [mm]': diameter, 'dose [%]': dose, 'recon': recon, 'std': std}).sort_values(by=['recon', 'diameter [mm]', 'dose [%]'])
+    keys = result_keys(results_dict)
+    std = [np.asarray(results_dict[d][dx][r]['std']) for d, dx, r in keys]
+    counts = [len(s) for s in std]
+    diameter, dose, recon = zip(*keys) if keys else ([], [], [])
+    return pd.DataFrame({'diameter [mm]': np.repeat(diameter, counts), 'dose [%]': np.repeat(dose, counts),
+                         'recon': np.repeat(np.array(recon, dtype=object), counts),
+                         'std': np.concatenate(std) if std else []}).sort_values(by=['recon', 'diameter [mm]', 'dose [%]'])
 
 
 def append_mean_std_to_summary_dataframe(results_dict, summary):
     noise_df = make_noise_dataframe(results_dict)
-    merged_noise = noise_df.groupby(['diameter [mm]', 'dose [%]', 'recon']).mean()
-    for d in summary['diameter [mm]'].unique():
-        for dx in summary['dose [%]'].unique():
-            for r in summary['recon'].unique():
-                if dx in noise_df['dose [%]'].unique():
-                    summary.loc[(summary['diameter [mm]']==d) & (summary['dose [%]']==dx) & (summary['recon']==r), 'mean std'] = merged_noise['std'][d, dx, r]
-    return summary
+    merged_noise = noise_df.groupby(SUMMARY_KEYS)['std'].mean()
+    return attach_to_summary(summary, merged_noise, 'mean std')
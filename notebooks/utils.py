@@ -3,6 +3,8 @@ import SimpleITK as sitk
 import numpy as np
 import pandas as pd
 from pathlib import Path
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import pydicom
 from skimage.transform import resize
 
@@ -37,13 +39,31 @@ def ctshow(img, window='soft_tissue'):
   return
 
 def circle_select(img, xy, r):
+    """boolean mask of the pixels of 2D `img` within radius `r` of `xy`, a writable copy of the cached `circle_mask`"""
     assert(img.ndim == 2)
-    circle_mask = np.zeros_like(img)
-    for i in range(circle_mask.shape[0]):
-        for j in range(circle_mask.shape[1]):
-            if (i-xy[0])**2 + (j-xy[1])**2 < r**2:
-                 circle_mask[i,j] = True
-    return circle_mask.astype(bool)
+    return circle_mask(img.shape, tuple(xy), r).copy()
+
+@lru_cache(maxsize=256)
+def circle_mask(shape, xy, r):
+    # cached and read-only as it is shared between callers, copy it before editing
+    i, j = np.ogrid[:shape[0], :shape[1]]
+    mask = (i - xy[0])**2 + (j - xy[1])**2 < r**2
+    mask.flags.writeable = False
+    return mask
+
+@lru_cache(maxsize=256)
+def circle_indices(shape, xy, r):
+    """flat indices of `circle_mask`, gather an ROI from a stack of images with `imgs.reshape(len(imgs), -1)[:, idx]`"""
+    idx = np.flatnonzero(circle_mask(shape, tuple(xy), r))
+    idx.flags.writeable = False
+    return idx
+
+def circle_masks(shape, centers, radii):
+    """batch of circular ROI masks (n, *shape) for n `centers` (n, 2) and a radius or n `radii`"""
+    centers = np.asarray(centers, dtype=float).reshape(-1, 2)
+    radii = np.broadcast_to(np.asarray(radii, dtype=float), len(centers))
+    i, j = np.ogrid[:shape[0], :shape[1]]
+    return (i[None] - centers[:, 0, None, None])**2 + (j[None] - centers[:, 1, None, None])**2 < radii[:, None, None]**2
 
 def get_circle_diameter(img):
     """Assumes an image of a uniform water phantom that can be easily segmented using a mean intensity threshold"""
@@ -360,15 +380,53 @@ def add_random_circle_lesion(image, mask, radius=20, contrast=-100):
 
 def noise_reduction(fbp_std, denoised_std): return 100*(fbp_std - denoised_std)/fbp_std
 
-def measure_roi_std_results(meta_df, roi_diameter=None):
+def roi_indices(gt, phantom, roi_diameter, first_image):
+    """flat indices of the noise ROI of a ground truth, a centred circle for uniform phantoms, else a random lesion sized circle in soft tissue"""
+    if phantom in ['uniform', 'MITA-LCD', 'ACR464']:
+        phantom_diameter_px = get_circle_diameter(gt)
+        circle_selection_diameter_px = roi_diameter*phantom_diameter_px # iec standard suggests centred circle ROI 40% of phantom diameter
+        return circle_indices(gt.shape, (gt.shape[0]//2, gt.shape[1]//2), circle_selection_diameter_px/2)
+    phantom_diameter_px = gt.shape[-1]/1.1 #assumes fov size of 110% effective diameter
+    circle_selection_diameter_px = roi_diameter*phantom_diameter_px
+    try:
+        return np.flatnonzero(add_random_circle_lesion(first_image, mask=((gt >= 50) & (gt < 100)), radius=circle_selection_diameter_px/2)[1])
+    except ValueError:
+        print(f"Warning: failed to insert lesion of diameter {circle_selection_diameter_px} into ground truth, considering using smaller `roi_diameter` current = {roi_diameter}")
+        return None
+
+def measure_roi_std_group(gt_file, files, phantom, roi_diameter, seed=None):
+    """noise std of every realization of each of `files`, all sharing the ground truth `gt_file`, whose image and ROI are loaded once
+
+    `seed` seeds the global `np.random` state used by `add_random_circle_lesion`, forked workers otherwise share one state
+    """
+    np.random.seed(seed)
+    gt = load_mhd(gt_file)
+    idx = None
+    stds = []
+    for n, f in enumerate(files):
+        img = load_mhd(f)
+        if img.ndim == 2: img = img[None, ...]
+        if n == 0:
+            idx = roi_indices(gt, phantom, roi_diameter, img[0])
+        if idx is None:
+            stds.append(np.full(len(img), np.nan))
+        else:
+            stds.append(img.reshape(len(img), -1)[:, idx].std(axis=1)) # all realizations in one masked reduction
+    return stds
+
+def measure_roi_std_results(meta_df, roi_diameter=None, num_workers=None, seed=None):
     """
     :Parameters:
         :meta_df: metadata dataframe
         :roi_diameter: diameter of circlular ROI. If `roi_diameter` is an **integer** then roi_diameter is in pixels e.g. 100, else if `roi_diameter` is **float** e.g. 0.3 then it is assumed a fraction of the phantom's effective diameter. Note for noise measurements IEC standard suggests centred circle ROI 40% of phantom diameter
+        :num_workers: processes measuring ground truth groups in parallel, defaults to all cores
+        :seed: seed of the random anthropomorphic ROIs, each ground truth group gets its own seed spawned from it
+
+    Rows sharing a ground truth are measured together by `measure_roi_std_group` so the ground truth and its ROI are loaded once,
+    for anthropomorphic phantoms the random ROI is therefore drawn once per ground truth and shared by its recons and doses.
+    Returns one row per realization with the `meta_df` columns, `sim number` and `noise std`
     """
-    meta_df = meta_df.copy()
-    meta_df['sim number'] = np.nan
-    meta_df['noise std'] = np.nan
+    meta_df = meta_df.reset_index(drop=True)
     default_diameters = {'uniform': 0.4, 'MITA-LCD':0.3, 'anthropomorphic': 0.2, 'ACR464': 0.4}
     if roi_diameter:
         if isinstance(roi_diameter, dict):
@@ -376,34 +434,22 @@ def measure_roi_std_results(meta_df, roi_diameter=None):
         else:
             default_diameters = {k: roi_diameter for k in default_diameters}
     roi_diameter = default_diameters
-    rows_list = []
-    for idx, patient in meta_df.iterrows():
-        if idx % (len(meta_df) // 10) == 0:
-            print(idx,'/',meta_df.shape[0])
-        img = load_mhd(patient.file)
-        if img.ndim == 2: img = img[None, ...]
-        gt = load_mhd(get_ground_truth(patient.file))
-        
-        if patient.phantom in ['uniform', 'MITA-LCD', 'ACR464']:
-            if (patient.phantom == 'ACR464') & (patient['FOV [cm]'] < 20):
-                 phantom_diameter_px = gt.shape[1] * 20/patient['FOV [cm]']
-            phantom_diameter_px = get_circle_diameter(gt)
-            circle_selection_diameter_px = roi_diameter[patient.phantom]*phantom_diameter_px # iec standard suggests centred circle ROI 40% of phantom diameter 
-            circle_selection = circle_select(gt, xy=(gt.shape[0]//2, gt.shape[1]//2), r = circle_selection_diameter_px/2)
-        else:
-            phantom_diameter_px = gt.shape[-1]/1.1 #assumes fov size of 110% effective diameter
-            circle_selection_diameter_px = roi_diameter[patient.phantom]*phantom_diameter_px
-            try:
-                circle_selection = add_random_circle_lesion(img[0], mask=((gt >= 50) & (gt < 100)), radius=circle_selection_diameter_px/2)[1].astype(bool)
-            except:
-                circle_selection = None
-                print(f"Warning: failed to insert lesion of diameter {circle_selection_diameter_px} into ground truth, considering using smaller `roi_diameter` current = {roi_diameter}")
-            
-        for n, o in enumerate(img):
-            patient['sim number'] = n
-            patient['noise std'] = o[circle_selection].std() if circle_selection is not None else np.nan
-            rows_list.append(pd.DataFrame(patient).T)
-    return pd.concat(rows_list, ignore_index=True)
+    groups = meta_df.groupby(meta_df.file.map(lambda f: str(get_ground_truth(f))), sort=False)
+    seeds = [int(s.generate_state(1)[0]) for s in np.random.SeedSequence(seed).spawn(groups.ngroups)]
+    stds = [None]*len(meta_df)
+    with ProcessPoolExecutor(num_workers) as pool:
+        futures = {pool.submit(measure_roi_std_group, gt_file, list(group.file), group.phantom.iloc[0], roi_diameter[group.phantom.iloc[0]], group_seed): group.index
+                   for (gt_file, group), group_seed in zip(groups, seeds)}
+        for count, future in enumerate(as_completed(futures), start=1):
+            if count % max(len(futures) // 10, 1) == 0:
+                print(count,'/',len(futures))
+            for row, std in zip(futures[future], future.result()):
+                stds[row] = std
+    counts = [len(std) for std in stds]
+    results = meta_df.loc[np.repeat(meta_df.index, counts)].reset_index(drop=True)
+    results['sim number'] = np.concatenate([np.arange(n) for n in counts])
+    results['noise std'] = np.concatenate(stds)
+    return results
 
 def rmse(x ,y): return np.sqrt(np.mean((x.ravel()-y.ravel())**2))
 